@@ -1,6 +1,7 @@
 import os
 import requests
 import base64
+import threading
 
 def get_spotify_access_token():
     spotify_client_id = os.getenv("SPOTIFY_CLIENT_ID")
@@ -25,3 +26,21 @@ def get_spotify_access_token():
 
     return json_result["access_token"]
 
+
+
+class TokenCache:
+    """Holds the spotify access token for a run, so it can be refreshed when it expires (after 1h)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token = get_spotify_access_token()
+
+    def get(self):
+        return self._token
+
+    def refresh(self, expired_token):
+        """Gets a new token, unless another caller already replaced the expired one"""
+        with self._lock:
+            if self._token == expired_token:
+                self._token = get_spotify_access_token()
+            return self._token
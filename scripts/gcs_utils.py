@@ -0,0 +1,43 @@
+from google.cloud import storage
+import orjson
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+"""
+    This module has the gcs helpers shared by the data acquisition scripts.
+    The storage client is created once per process and reused by every script and helper.
+"""
+
+# Number of threads used for the blocking gcs calls. They all share the one storage client, so this is
+# kept under its http connection pool size (10), otherwise keep-alive connections get discarded.
+GCS_WORKERS = 8
+
+
+@lru_cache(maxsize=1)
+def get_gcs_client():
+    """Gets the gcs client, it is only created (credentials loaded, connection pool built) on the first call"""
+    return storage.Client.from_service_account_json("gcp_creds.json")
+
+
+def get_artists_from_gcs(bucket_name, blob_name):
+    """Gets the artists from the gcs bucket"""
+    try:
+        bucket = get_gcs_client().bucket(bucket_name)
+        blob = bucket.blob(blob_name)
+        artists = orjson.loads(blob.download_as_bytes())
+        return artists
+    except Exception as e:
+        logger.error(
+            f"Error getting artists from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
+        )
+        raise Exception(
+            f"Error getting artists from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
+        )
+
+
+def upload_json_to_gcs(blob, data):
+    """Uploads the data to the blob as compact utf-8 json. upload_from_string sends payloads up to 8 MiB
+    in a single request, which is cheaper than the resumable upload session always used by blob.open()."""
+    blob.upload_from_string(orjson.dumps(data), content_type="application/json")
@@ -1,10 +1,10 @@
-from google.cloud import storage
-from auth import get_spotify_access_token
-import requests
-import json
+from gcs_utils import GCS_WORKERS, get_gcs_client, get_artists_from_gcs, upload_json_to_gcs
+from auth import TokenCache
+from spotify_utils import spotify_get_async, make_spotify_session
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import time
-from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 import argparse
 
 logging.basicConfig(
@@ -18,54 +18,26 @@ logger = logging.getLogger(__name__)
     The json data is uploaded to a gcs bucket.
 """
 
-
-def get_artists_from_gcs(bucket_name, blob_name):
-    """Gets the artists from the gcs bucket"""
-    try:
-        client = storage.Client.from_service_account_json("gcp_creds.json")
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        artists = json.loads(blob.download_as_string())
-        return artists
-    except Exception as e:
-        logger.error(
-            f"Error getting artists from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
-        )
-        raise Exception(
-            f"Error getting artists from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
-        )
+# Max number of artists whose albums are fetched from the spotify api at the same time.
+SPOTIFY_CONCURRENCY = 20
 
 
-def get_albums_from_spotify(spotify_artist_id, token, max_retries=3, sleep_time=1):
+async def get_albums_from_spotify(session, spotify_artist_id, token_cache):
     """Gets the albums from the spotify api for a given artist"""
     url = f"https://api.spotify.com/v1/artists/{spotify_artist_id}/albums"
-    headers = {"Authorization": f"Bearer {token}"}
     params = {"limit": 50, "include_groups": "album,single", "market": "US"}
 
     all_album_items = []
     page_url, page_params = url, params
 
     while True:
-        success = False
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(page_url, headers=headers, params=page_params, timeout=10)
-
-                response.raise_for_status()
-                data = response.json()
-                success = True
-                break
-            except Exception as e:
-                backoff_time = sleep_time * (2 ** attempt)
-                logger.warning(
-                    f"Error getting artist's albums page from Spotify: {e}. Retrying in {backoff_time} seconds (attempt {attempt+1}/{max_retries})."
-                )
-                time.sleep(backoff_time)
-        if not success:
-            raise RuntimeError(
-                f"Error getting albums from Spotify for artist {spotify_artist_id}. Failed after {max_retries} attempts."
-            )
-
+        data = await spotify_get_async(
+            session,
+            page_url,
+            token_cache,
+            params=page_params,
+            description=f"albums page for artist {spotify_artist_id}",
+        )
         all_album_items.extend(data.get("items", []))
 
         next_url = data.get("next")
@@ -74,43 +46,66 @@ def get_albums_from_spotify(spotify_artist_id, token, max_retries=3, sleep_time=
         page_url, page_params = next_url, None
 
 
-def process_albums_from_spotify(artist, token):
+async def process_albums_from_spotify(session, artist, token_cache):
     """Processes the albums for a given artist from the spotify api"""
     try:
         album_list = []
-        all_album_items = get_albums_from_spotify(artist["spotify_artist_id"], token)
+        all_album_items = await get_albums_from_spotify(
+            session, artist["spotify_artist_id"], token_cache
+        )
         for album in all_album_items:
-            individual_album = {}
-            individual_album["spotify_album_id"] = album["id"]
-            individual_album["spotify_artist_id"] = artist["spotify_artist_id"]
-            individual_album["album"] = album["name"]
-            individual_album["artist"] = artist["artist"]
-            individual_album["spotify_url"] = album["external_urls"]["spotify"]
-            individual_album["type"] = album["album_type"]
-            individual_album["release_date"] = album["release_date"]
-            individual_album["total_tracks"] = album["total_tracks"]
-            individual_album["is_processed"] = False
-            individual_album["images"] = album["images"]
+            individual_album = {
+                "spotify_album_id": album["id"],
+                "spotify_artist_id": artist["spotify_artist_id"],
+                "album": album["name"],
+                "artist": artist["artist"],
+                "spotify_url": album["external_urls"]["spotify"],
+                "type": album["album_type"],
+                "release_date": album["release_date"],
+                "total_tracks": album["total_tracks"],
+                "is_processed": False,
+                "images": album["images"],
+            }
             album_list.append(individual_album)
         return album_list
     except Exception as e:
         logger.error(f"Error processing albums from spotify: {e}")
         raise Exception(f"Error processing albums from spotify: {e}")
 
+
+async def write_artist_albums_to_gcs(session, semaphore, executor, artist, token_cache, bucket):
+    """Gets the albums for a given artist and writes them to the gcs bucket"""
+    async with semaphore:
+        albums = await process_albums_from_spotify(session, artist, token_cache)
+    blob = bucket.blob(f"{artist['full_blob_name']}/albums.json")
+    # Uploaded after releasing the semaphore, so the next artist's albums are fetched while this upload runs.
+    await asyncio.get_running_loop().run_in_executor(
+        executor, upload_json_to_gcs, blob, albums
+    )
+
+
+async def write_albums_to_gcs_async(artists, bucket, token_cache, concurrency=SPOTIFY_CONCURRENCY):
+    """Gets and writes the albums for all the artists concurrently, sharing one http session"""
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as executor:
+        async with make_spotify_session() as session:
+            await tqdm_asyncio.gather(
+                *[
+                    write_artist_albums_to_gcs(
+                        session, semaphore, executor, artist, token_cache, bucket
+                    )
+                    for artist in artists
+                ]
+            )
+
+
 def write_albums_to_gcs(artists, bucket_name, base_blob_name):
     """Writes the albums to the gcs bucket"""
     try:
-        token = get_spotify_access_token()
-        client = storage.Client.from_service_account_json("gcp_creds.json")
+        token_cache = TokenCache()
+        client = get_gcs_client()
         bucket = client.bucket(bucket_name)
-        for artist in tqdm(artists):
-            blob = bucket.blob(f"{artist['full_blob_name']}/albums.json")
-            albums = process_albums_from_spotify(artist, token)
-            blob.upload_from_string(
-                json.dumps(albums, indent=3, ensure_ascii=False),
-                content_type="application/json",
-            )
-            time.sleep(0.5)
+        asyncio.run(write_albums_to_gcs_async(artists, bucket, token_cache))
         logger.info(
             f"Successfully wrote albums for {len(artists)} artists to gcs bucket {bucket_name} with base blob name {base_blob_name}"
         )
@@ -1,12 +1,10 @@
-import requests
-from bs4 import BeautifulSoup
-from auth import get_spotify_access_token
+import lxml.html
+from auth import TokenCache
+from spotify_utils import SESSION, spotify_get
 from tqdm import tqdm
-from datetime import datetime
-import json
-import time
+from datetime import datetime, timezone
 import logging
-from google.cloud import storage
+from gcs_utils import get_gcs_client, upload_json_to_gcs
 import argparse
 import os
 
@@ -37,7 +35,7 @@ def get_artists_kworb(page_number):
             url = BASE_URL.format(page_number=page_number)
 
         # return the html of the page
-        response = requests.get(url, headers=headers, timeout=10)
+        response = SESSION.get(url, headers=headers, timeout=10)
         response.raise_for_status()
         logger.info(f"Successfully got html of page {page_number} from kworb's page")
         response.encoding = "utf-8"
@@ -54,15 +52,17 @@ def process_kworb_html(page_number):
     try:
         html = get_artists_kworb(page_number)
 
-        soup = BeautifulSoup(html, "lxml")
-        tr_list = soup.find_all("tr")
+        # Parse with lxml directly, it is much faster than building BeautifulSoup's wrapper objects for every node.
+        tree = lxml.html.fromstring(html)
+        tr_list = tree.xpath("//tr")
 
         # Get the column map for the artist and listeners columns from the header row to later easily access the data and create a json data structure.
         artist_column_map = {}
-        for i, th in enumerate(tr_list[0].find_all("th")):
+        for i, th in enumerate(tr_list[0].xpath(".//th")):
             # Artist and Listeners are the columns we are interested in from kworb's page
-            if th.text.strip() == "Artist" or th.text.strip() == "Listeners":
-                artist_column_map[i] = th.text.strip()
+            column_name = th.text_content().strip()
+            if column_name == "Artist" or column_name == "Listeners":
+                artist_column_map[i] = column_name
 
         # Create a list of dictionaries for each artist and their data
         artists = []
@@ -76,22 +76,23 @@ def process_kworb_html(page_number):
                 "last_processed_at": None,
                 "full_blob_name": None,
             }
-            for i, td in enumerate(tr.find_all("td")):
+            for i, td in enumerate(tr.xpath(".//td")):
                 if i in artist_column_map:
-                    if td.find("a"):
-                        href = td.find("a")["href"]
-                        second_part = href.split("/")[-1]
+                    hrefs = td.xpath(".//a/@href")
+                    if hrefs:
+                        second_part = hrefs[0].split("/")[-1]
                         spotify_artist_id = second_part.split("_")[0]
                         individual_artist["spotify_artist_id"] = spotify_artist_id
-                    if td.text.strip():
+                    td_text = td.text_content().strip()
+                    if td_text:
                         if artist_column_map[i] == "Listeners":
                             individual_artist["metrics"] = {}
                             individual_artist["metrics"]["kworb"] = {}
                             individual_artist["metrics"]["kworb"][
                                 "monthly_listeners"
-                            ] = int(td.text.strip().replace(",", ""))
+                            ] = int(td_text.replace(",", ""))
                         elif artist_column_map[i] == "Artist":
-                            individual_artist["artist"] = td.text.strip()
+                            individual_artist["artist"] = td_text
                         individual_artist["full_blob_name"] = None
             artists.append(individual_artist)
 
@@ -108,56 +109,34 @@ def process_kworb_html(page_number):
         )
 
 
-def fetch_artists_batch_spotify(batch_artist_list, token, max_retries=3, sleep_time=1):
+def fetch_artists_batch_spotify(batch_artist_list, token_cache):
     """Gets batch of artists from the spotify api"""
-    for attempt in range(max_retries):
-        try:
-            headers = {"Authorization": f"Bearer {token}"}
-            url = "https://api.spotify.com/v1/artists"
-
-            spotify_artist_ids = [artist["spotify_artist_id"] for artist in batch_artist_list]
-            spotify_artist_ids_str = ",".join(spotify_artist_ids)
-            params = {"ids": spotify_artist_ids_str}
-
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            backoff_time = sleep_time * (2**attempt)
-            logger.warning(
-                f"Error getting artists from spotify api: {e}. Retrying in {backoff_time} seconds."
-            )
-            time.sleep(backoff_time)
-    logger.error(
-        f"Error getting artists from spotify api. Failed after {max_retries} attempts."
-    )
-    raise RuntimeError(
-        f"Error getting artists from spotify api. Failed after {max_retries} attempts."
+    spotify_artist_ids = [artist["spotify_artist_id"] for artist in batch_artist_list]
+    return spotify_get(
+        SESSION,
+        "https://api.spotify.com/v1/artists",
+        token_cache,
+        params={"ids": ",".join(spotify_artist_ids)},
+        description="artists batch",
     )
 
 
 def process_spotify_response(artists, batch_size=50):
     """Processes the spotify response for batches of artists"""
-    token = get_spotify_access_token()
+    token_cache = TokenCache()
+    # All the artists of a run share the same processing time, so the timestamp is formatted once.
+    processed_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
     try:
         for i in tqdm(range(0, len(artists), batch_size)):
             batch_artist_list = artists[i : i + batch_size]
-            response = fetch_artists_batch_spotify(batch_artist_list, token)
+            response = fetch_artists_batch_spotify(batch_artist_list, token_cache)
             for index, artist in enumerate(batch_artist_list):
                 artist["spotify_url"] = response["artists"][index]["external_urls"][
                     "spotify"
                 ]
                 if artist["init_processed_at"] is None:
-                    artist["init_processed_at"] = datetime.now().strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
-                    artist["last_processed_at"] = datetime.now().strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
-                else:
-                    artist["last_processed_at"] = datetime.now().strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
+                    artist["init_processed_at"] = processed_at
+                artist["last_processed_at"] = processed_at
 
                 artist["metrics"]["spotify"] = {}
                 artist["metrics"]["spotify"]["followers"] = int(
@@ -169,7 +148,6 @@ def process_spotify_response(artists, batch_size=50):
                 artist["spotify_meta"] = {}
                 artist["spotify_meta"]["genres"] = response["artists"][index]["genres"]
                 artist["spotify_meta"]["images"] = response["artists"][index]["images"]
-            time.sleep(1)
         return artists
     except Exception as e:
         logger.error(f"Error processing spotify response: {e}")
@@ -178,7 +156,7 @@ def process_spotify_response(artists, batch_size=50):
 
 def write_artists_to_gcs(artists, bucket_name, base_blob_name, batch_size=GCS_BATCH_SIZE):
     """Writes the artist list to a json file in a gcp bucket"""
-    client = storage.Client.from_service_account_json("gcp_creds.json")
+    client = get_gcs_client()
     bucket = client.bucket(bucket_name)
     batch_number = 1
     for i in tqdm(range(0, len(artists), batch_size)):
@@ -187,10 +165,7 @@ def write_artists_to_gcs(artists, bucket_name, base_blob_name, batch_size=GCS_BA
             for artist in batch_artists:
                 artist["full_blob_name"] = f"{base_blob_name}/batch{batch_number}/{artist['spotify_artist_id']}"
             blob = bucket.blob(f"{base_blob_name}/batch{batch_number}/artists.json")
-            blob.upload_from_string(
-                json.dumps(batch_artists, indent=3, ensure_ascii=False),
-                content_type="application/json",
-            )
+            upload_json_to_gcs(blob, batch_artists)
             logger.info(
                 f"Successfully wrote artists to gcs bucket {bucket_name} with blob name {base_blob_name}/batch{batch_number}/artists.json"
             )
@@ -1,10 +1,12 @@
-from google.cloud import storage
-from auth import get_spotify_access_token
-import requests
-import json
+from gcs_utils import GCS_WORKERS, get_gcs_client, get_artists_from_gcs, upload_json_to_gcs
+from auth import TokenCache
+from spotify_utils import SESSION, spotify_get, spotify_get_async, make_spotify_session
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import logging
-import time
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 import argparse
 
 logging.basicConfig(
@@ -18,116 +20,89 @@ logger = logging.getLogger(__name__)
     The json data is uploaded to a gcs bucket.
 """
 
-
-def get_artists_from_gcs(bucket_name, blob_name):
-    """Gets the artists from the gcs bucket"""
-    try:
-        client = storage.Client.from_service_account_json("gcp_creds.json")
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        artists = json.loads(blob.download_as_string())
-        return artists
-    except Exception as e:
-        logger.error(
-            f"Error getting artists from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
-        )
-        raise Exception(
-            f"Error getting artists from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
-        )
+# Max number of artists whose albums' songs are fetched from the spotify api at the same time.
+SPOTIFY_CONCURRENCY = 10
+# Max number of album ids the spotify api accepts in a single /v1/albums request.
+SPOTIFY_ALBUMS_BATCH_SIZE = 20
 
 
-def get_albums_from_gcs(artist, bucket_name):
-    """Gets the albums from the gcs bucket for a given artist"""
+def get_albums_from_gcs(artist, bucket):
+    """Gets the albums from the gcs bucket for a given artist. The bucket is passed in so its client is reused between artists."""
+    blob_name = f"{artist['full_blob_name']}/albums.json"
     try:
-        client = storage.Client.from_service_account_json("gcp_creds.json")
-        bucket = client.bucket(bucket_name)
-        blob_name = f"{artist['full_blob_name']}/albums.json"
         blob = bucket.blob(blob_name)
-        albums = json.loads(blob.download_as_string())
+        albums = orjson.loads(blob.download_as_bytes())
         return albums
     except Exception as e:
         logger.error(
-            f"Error getting albums from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
+            f"Error getting albums from gcs bucket {bucket.name} with blob name {blob_name}: {e}"
         )
         raise Exception(
-            f"Error getting albums from gcs bucket {bucket_name} with blob name {blob_name}: {e}"
+            f"Error getting albums from gcs bucket {bucket.name} with blob name {blob_name}: {e}"
         )
 
 
-def get_all_artist_songs_from_gcs(artist, bucket_name):
+def get_all_artist_songs_from_gcs(artist, bucket):
     """Gets all the songs combined from the gcs bucket for a given artist"""
     try:
-        client = storage.Client.from_service_account_json("gcp_creds.json")
-        bucket = client.bucket(bucket_name)
         blob = bucket.blob(f"{artist['full_blob_name']}/songs.json")
-        return json.loads(blob.download_as_string())
+        return orjson.loads(blob.download_as_bytes())
     except Exception as e:
         logger.error(
-            f"Error getting all artist songs from gcs bucket {bucket_name} with blob name {artist['full_blob_name']}/songs.json: {e}"
+            f"Error getting all artist songs from gcs bucket {bucket.name} with blob name {artist['full_blob_name']}/songs.json: {e}"
         )
         raise Exception(
-            f"Error getting all artist songs from gcs bucket {bucket_name} with blob name {artist['full_blob_name']}/songs.json: {e}"
+            f"Error getting all artist songs from gcs bucket {bucket.name} with blob name {artist['full_blob_name']}/songs.json: {e}"
         )
 
 
-def fetch_album_songs_from_spotify(album_id, token, max_retries=3, sleep_time=1):
-    """Gets the songs from the spotify api"""
-    for attempt in range(max_retries):
-        try:
-            url = f"https://api.spotify.com/v1/albums/{album_id}/tracks"
-            headers = {"Authorization": f"Bearer {token}"}
-            params = {"limit": 50}
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            backoff_time = sleep_time * (2**attempt)
-            logger.warning(
-                f"Error getting album songs from spotify: {e}. Retrying in {backoff_time} seconds."
-            )
-            time.sleep(backoff_time)
-    logger.error(f"Error getting album songs from spotify: {e}")
-    raise Exception(f"Error getting album songs from spotify: {e}")
+async def fetch_albums_batch_from_spotify(session, album_ids, token_cache):
+    """Gets a batch of up to 20 albums from the spotify api, each album includes its first page of songs"""
+    return await spotify_get_async(
+        session,
+        "https://api.spotify.com/v1/albums",
+        token_cache,
+        params={"ids": ",".join(album_ids)},
+        description="albums batch",
+    )
 
 
-def fetch_artist_top_tracks_from_spotify(artist_id, token, max_retries=3, sleep_time=1):
+async def fetch_album_songs_from_spotify(session, page_url, token_cache):
+    """Gets a page of songs from the spotify api for a given album, from the `next` url of the previous page"""
+    return await spotify_get_async(
+        session, page_url, token_cache, description="album songs"
+    )
+
+
+def fetch_artist_top_tracks_from_spotify(artist_id, token_cache):
     """Gets the top tracks from the spotify api for a given artist"""
-    for attempt in range(max_retries):
-        try:
-            url = f"https://api.spotify.com/v1/artists/{artist_id}/top-tracks"
-            headers = {"Authorization": f"Bearer {token}"}
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            backoff_time = sleep_time * (2**attempt)
-            logger.warning(
-                f"Error getting artist top tracks from spotify: {e}. Retrying in {backoff_time} seconds."
-            )
-            time.sleep(backoff_time)
-    logger.error(f"Error getting artist top tracks from spotify: {e}")
-    raise Exception(f"Error getting artist top tracks from spotify: {e}")
+    return spotify_get(
+        SESSION,
+        f"https://api.spotify.com/v1/artists/{artist_id}/top-tracks",
+        token_cache,
+        description="artist top tracks",
+    )
 
 
-def process_album_songs_from_spotify(album, token):
+def process_album_songs_from_spotify(album, songs):
     """Processes the songs from the spotify api for a given album"""
     try:
         songs_list = []
-        songs = fetch_album_songs_from_spotify(album["spotify_album_id"], token)
-        for song in songs["items"]:
-            individual_song = {}
-            individual_song["spotify_song_id"] = song["id"]
-            individual_song["spotify_album_id"] = album["spotify_album_id"]
-            individual_song["spotify_artist_id"] = album["spotify_artist_id"]
-            individual_song["name"] = song["name"]
-            individual_song["album"] = album["album"]
-            individual_song["artists"] = [artist["name"] for artist in song["artists"]]
-            individual_song["primary_artist"] = song["artists"][0]["name"]
-            individual_song["spotify_url"] = song["external_urls"]["spotify"]
-            individual_song["release_date"] = album["release_date"]
-            individual_song["duration_ms"] = song["duration_ms"]
-            individual_song["explicit"] = song["explicit"]
-            individual_song["images"] = album["images"]
+        for song in songs:
+            individual_song = {
+                "spotify_song_id": song["id"],
+                "spotify_album_id": album["spotify_album_id"],
+                "spotify_artist_id": album["spotify_artist_id"],
+                "name": song["name"],
+                "album": album["album"],
+                "artists": [artist["name"] for artist in song["artists"]],
+                "primary_artist": song["artists"][0]["name"],
+                "spotify_url": song["external_urls"]["spotify"],
+                "release_date": album["release_date"],
+                "duration_ms": song["duration_ms"],
+                "explicit": song["explicit"],
+                "images": album["images"],
+            }
             songs_list.append(individual_song)
         return songs_list
     except Exception as e:
@@ -135,43 +110,42 @@ def process_album_songs_from_spotify(album, token):
         raise Exception(f"Error processing album songs from spotify: {e}")
 
 
-def process_artist_top_tracks_from_spotify(artist, token, top_n_tracks=10):
+def process_artist_top_tracks_from_spotify(artist, token_cache, top_n_tracks=10):
     """Processes the top tracks from the spotify api for a given artist, only includes singles"""
     try:
         top_songs = []
         top_tracks = fetch_artist_top_tracks_from_spotify(
-            artist["spotify_artist_id"], token
+            artist["spotify_artist_id"], token_cache
         )
         for track in top_tracks["tracks"][:top_n_tracks]:
-                individual_song = {}
-                individual_song["spotify_song_id"] = track["id"]
-                individual_song["spotify_album_id"] = track["album"]["id"]
-                individual_song["spotify_artist_id"] = artist["spotify_artist_id"]
-                individual_song["name"] = track["name"]
-                individual_song["album"] = track["album"]["name"]
-                individual_song["artists"] = [
-                    artist["name"] for artist in track["artists"]
-                ]
-                individual_song["primary_artist"] = track["artists"][0]["name"]
-                individual_song["spotify_url"] = track["external_urls"]["spotify"]
-                individual_song["release_date"] = track["album"]["release_date"]
-                individual_song["duration_ms"] = track["duration_ms"]
-                individual_song["explicit"] = track["explicit"]
-                individual_song["images"] = track["album"]["images"]
-                top_songs.append(individual_song)
+            individual_song = {
+                "spotify_song_id": track["id"],
+                "spotify_album_id": track["album"]["id"],
+                "spotify_artist_id": artist["spotify_artist_id"],
+                "name": track["name"],
+                "album": track["album"]["name"],
+                "artists": [artist["name"] for artist in track["artists"]],
+                "primary_artist": track["artists"][0]["name"],
+                "spotify_url": track["external_urls"]["spotify"],
+                "release_date": track["album"]["release_date"],
+                "duration_ms": track["duration_ms"],
+                "explicit": track["explicit"],
+                "images": track["album"]["images"],
+            }
+            top_songs.append(individual_song)
         return top_songs
     except Exception as e:
         logger.error(f"Error processing artist top tracks from spotify: {e}")
         raise Exception(f"Error processing artist top tracks from spotify: {e}")
 
 
-def dedupe_single_songs(artist, token, bucket_name):
+def dedupe_single_songs(artist, token_cache, bucket):
     """Dedupe the songs. This removes songs that are already in the albums, and leaves singles
     in the top 10 songs of the artist."""
     try:
         deduped_songs = []
-        top_songs = process_artist_top_tracks_from_spotify(artist, token)
-        all_album_songs = get_all_artist_songs_from_gcs(artist, bucket_name)
+        top_songs = process_artist_top_tracks_from_spotify(artist, token_cache)
+        all_album_songs = get_all_artist_songs_from_gcs(artist, bucket)
         for song in top_songs:
             if song["spotify_song_id"] not in [
                 song["spotify_song_id"] for song in all_album_songs
@@ -184,38 +158,91 @@ def dedupe_single_songs(artist, token, bucket_name):
         raise Exception(f"Error deduping single songs: {e}")
 
 
-def write_album_songs_to_gcs(artists, bucket_name, base_blob_name):
-    """Writes the songs from an album for an aritst inside the album's folder"""
-    try:
-        token = get_spotify_access_token()
-        client = storage.Client.from_service_account_json("gcp_creds.json")
-        bucket = client.bucket(bucket_name)
-        for artist in tqdm(artists):
-            albums = get_albums_from_gcs(artist, bucket_name)
-            all_album_songs = []
-            for album in albums:
-                if album["type"] == "album":
-                    blob = bucket.blob(
-                        f"{artist['full_blob_name']}/{album['spotify_album_id']}/songs.json"
-                    )
-                    songs = process_album_songs_from_spotify(album, token)
-                    blob.upload_from_string(
-                        json.dumps(songs, indent=3, ensure_ascii=False),
-                        content_type="application/json",
-                    )
-                    all_album_songs.extend(songs)
-                    time.sleep(0.5)
-            logger.info(
-                f"Successfully wrote albums' songs for {len(albums)} albums for artist {artist['artist']} to gcs bucket {bucket_name} with blob name {base_blob_name} and seperate folders for each album."
+async def process_albums_batch_songs_from_spotify(session, albums, token_cache):
+    """Processes the songs from the spotify api for a batch of up to 20 albums, using one request for the whole batch"""
+    albums_batch = await fetch_albums_batch_from_spotify(
+        session, [album["spotify_album_id"] for album in albums], token_cache
+    )
+    songs_list = []
+    # Spotify returns the albums in the same order as the requested ids, null for ids it doesn't know.
+    for album, spotify_album in zip(albums, albums_batch["albums"]):
+        if spotify_album is None:
+            logger.warning(
+                f"Album {album['spotify_album_id']} was not found on spotify, skipping it."
             )
-            blob = bucket.blob(f"{artist['full_blob_name']}/songs.json")
-            blob.upload_from_string(
-                json.dumps(all_album_songs, indent=3, ensure_ascii=False),
-                content_type="application/json",
+            continue
+        songs = spotify_album["tracks"]["items"]
+        # Only the first page of songs is included in the batch, the rest are fetched by following the `next` urls.
+        next_url = spotify_album["tracks"]["next"]
+        while next_url:
+            page = await fetch_album_songs_from_spotify(session, next_url, token_cache)
+            songs.extend(page["items"])
+            next_url = page["next"]
+        songs_list.extend(process_album_songs_from_spotify(album, songs))
+    return songs_list
+
+
+async def process_artist_album_songs_from_spotify(session, albums, token_cache):
+    """Processes the songs from the spotify api for all the albums of an artist, in concurrent batches of albums, keeping the albums' order"""
+    albums = [album for album in albums if album["type"] == "album"]
+    batch_songs = await asyncio.gather(
+        *[
+            process_albums_batch_songs_from_spotify(
+                session, albums[i : i + SPOTIFY_ALBUMS_BATCH_SIZE], token_cache
             )
-            logger.info(
-                f"Successfully wrote {len(all_album_songs)} albums' songs for {artist['artist']} to gcs bucket {bucket_name} with blob name {base_blob_name}/songs.json"
+            for i in range(0, len(albums), SPOTIFY_ALBUMS_BATCH_SIZE)
+        ]
+    )
+    return [song for songs in batch_songs for song in songs]
+
+
+def upload_artist_songs_to_gcs(artist, songs, bucket, base_blob_name):
+    """Writes all the songs of an artist to a single json file in the artist's folder"""
+    blob = bucket.blob(f"{artist['full_blob_name']}/songs.json")
+    upload_json_to_gcs(blob, songs)
+    logger.info(
+        f"Successfully wrote {len(songs)} albums' songs for {artist['artist']} to gcs bucket {bucket.name} with blob name {base_blob_name}/songs.json"
+    )
+
+
+async def write_artist_album_songs_to_gcs(session, semaphore, executor, artist, token_cache, bucket, base_blob_name):
+    """Gets the songs of all the albums of a given artist and writes them to the gcs bucket"""
+    loop = asyncio.get_running_loop()
+    # Downloaded before taking the semaphore, so the gcs downloads are prefetched behind the other artists' spotify requests.
+    albums = await loop.run_in_executor(executor, get_albums_from_gcs, artist, bucket)
+    async with semaphore:
+        all_album_songs = await process_artist_album_songs_from_spotify(
+            session, albums, token_cache
+        )
+    # Uploaded after releasing the semaphore, so the next artist's songs are fetched while this upload runs.
+    await loop.run_in_executor(
+        executor, upload_artist_songs_to_gcs, artist, all_album_songs, bucket, base_blob_name
+    )
+
+
+async def write_album_songs_to_gcs_async(artists, bucket, token_cache, base_blob_name, concurrency=SPOTIFY_CONCURRENCY):
+    """Gets and writes the songs for all the artists concurrently, sharing one http session. The artists' albums
+    are downloaded from gcs on the thread pool ahead of time, and the semaphore only caps the spotify requests."""
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as executor:
+        async with make_spotify_session() as session:
+            await tqdm_asyncio.gather(
+                *[
+                    write_artist_album_songs_to_gcs(
+                        session, semaphore, executor, artist, token_cache, bucket, base_blob_name
+                    )
+                    for artist in artists
+                ]
             )
+
+
+def write_album_songs_to_gcs(artists, bucket_name, base_blob_name):
+    """Writes the songs from all the albums of an artist to a single songs.json file in the artist's folder"""
+    try:
+        token_cache = TokenCache()
+        client = get_gcs_client()
+        bucket = client.bucket(bucket_name)
+        asyncio.run(write_album_songs_to_gcs_async(artists, bucket, token_cache, base_blob_name))
         logger.info(
             f"Successfully wrote albums' songs for {len(artists)} artists to gcs bucket {bucket_name} with blob name {base_blob_name}"
         )
@@ -229,36 +256,21 @@ def write_album_songs_to_gcs(artists, bucket_name, base_blob_name):
 
 
 def write_single_songs_to_gcs(artists, bucket_name, base_blob_name):
-    """Writes the single songs to the album's folder"""
+    """Adds the single songs to the songs.json file in the artist's folder"""
     try:
-        token = get_spotify_access_token()
-        client = storage.Client.from_service_account_json("gcp_creds.json")
+        token_cache = TokenCache()
+        client = get_gcs_client()
         bucket = client.bucket(bucket_name)
 
         for artist in tqdm(artists):
-            single_songs = dedupe_single_songs(artist, token, bucket_name)
-            for song in single_songs:
-                blob = bucket.blob(
-                    f"{artist['full_blob_name']}/{song['spotify_album_id']}/songs.json"
-                )
-                blob.upload_from_string(
-                    json.dumps(single_songs, indent=3, ensure_ascii=False),
-                    content_type="application/json",
-                )
-            logger.info(
-                f"Successfully wrote {len(single_songs)} single songs for artist {artist['artist']} to gcs bucket {bucket_name} with blob name {base_blob_name} and seperate folders for each single."
-            )
+            single_songs = dedupe_single_songs(artist, token_cache, bucket)
             blob = bucket.blob(f"{artist['full_blob_name']}/songs.json")
-            existing_songs = json.loads(blob.download_as_string())
+            existing_songs = orjson.loads(blob.download_as_bytes())
             existing_songs.extend(single_songs)
-            blob.upload_from_string(
-                json.dumps(existing_songs, indent=3, ensure_ascii=False),
-                content_type="application/json",
-            )
+            upload_json_to_gcs(blob, existing_songs)
             logger.info(
                 f"Successfully added {len(single_songs)} single songs to {len(existing_songs)} existing songs for artist {artist['artist']}"
             )
-            time.sleep(0.5)
         logger.info(
             f"Successfully wrote single songs for {len(artists)} artists to gcs bucket {bucket_name} with blob name {base_blob_name}"
         )
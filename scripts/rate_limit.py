@@ -0,0 +1,121 @@
+import asyncio
+import random
+import threading
+import time
+
+"""
+    This module is used by the data acquisition scripts to stay under the spotify api's rate limit.
+    It has a token bucket rate limiter shared by every spotify call in the process, which works with both
+    `with` (requests) and `async with` (aiohttp), and helpers to handle 429 responses and retry backoff.
+    The limiter adapts its rate (AIMD): it halves the rate on a 429 and slowly raises it back after successful requests.
+"""
+
+# Max number of requests per second sent to the spotify api.
+SPOTIFY_RATE_LIMIT = 25
+# Number of successful requests after which the rate is raised by one request per second.
+SPOTIFY_RATE_INCREASE_INTERVAL = 50
+
+
+class RateLimiter:
+    """Token bucket rate limiter. Every caller takes a token before sending a request, and pause()
+    makes all callers wait, which is used when spotify answers with a 429 and a Retry-After header.
+    The rate starts at max_rate, is halved by on_throttle() and raised by one after every `increase_interval` on_success() calls."""
+
+    def __init__(self, max_rate, per=1.0, min_rate=1, increase_interval=SPOTIFY_RATE_INCREASE_INTERVAL):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.per = per
+        self.increase_interval = increase_interval
+        self._successes = 0
+        self._tokens = max_rate
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        # A threading lock is used so the limiter can be shared by threads and coroutines. It is never held while waiting.
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Takes a token if there is one, otherwise returns the number of seconds to wait before trying again"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._tokens = min(
+                self.rate, self._tokens + (now - self._last_refill) * self.rate / self.per
+            )
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) * self.per / self.rate
+
+    def pause(self, seconds):
+        """Stops handing out tokens for the given number of seconds"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            # Start from an empty bucket after the pause so the waiting callers don't all fire at once.
+            self._tokens = 0
+            self._last_refill = self._paused_until
+
+    def on_success(self):
+        """Additive increase, called after every successful request"""
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.increase_interval:
+                self._successes = 0
+                self.rate = min(self.max_rate, self.rate + 1)
+
+    def on_throttle(self, seconds):
+        """Multiplicative decrease, called on a 429. It halves the rate and pauses for the Retry-After seconds.
+        Only the first 429 of a pause lowers the rate, the other requests in flight were sent at the old rate."""
+        with self._lock:
+            if time.monotonic() >= self._paused_until:
+                self.rate = max(self.min_rate, self.rate / 2)
+            self._successes = 0
+        self.pause(seconds)
+
+    def acquire(self):
+        """Blocks until a token is available"""
+        while True:
+            wait_time = self._reserve()
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+    async def acquire_async(self):
+        """Waits until a token is available without blocking the event loop"""
+        while True:
+            wait_time = self._reserve()
+            if not wait_time:
+                return
+            await asyncio.sleep(wait_time)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+spotify_limiter = RateLimiter(SPOTIFY_RATE_LIMIT)
+
+
+def get_retry_after(headers, default):
+    """Gets the number of seconds to wait from the Retry-After header of a 429 response"""
+    try:
+        return float(headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_backoff_time(sleep_time, attempt):
+    """Exponential backoff with jitter, so that workers failing at the same time don't all retry at the same time"""
+    return sleep_time * (2**attempt) * random.uniform(0.5, 1.5)
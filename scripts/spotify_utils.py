@@ -0,0 +1,128 @@
+from rate_limit import spotify_limiter, get_retry_after, get_backoff_time
+import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
+import asyncio
+import orjson
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+"""
+    This module has the spotify api helpers shared by the data acquisition scripts.
+    Every GET to the spotify api goes through spotify_get (requests) or spotify_get_async (aiohttp), which own the retry policy:
+    the shared rate limiter, refreshing the access token on a 401, pausing on a 429, and backing off with jitter on other errors.
+"""
+
+# One requests session for the whole run so connections (and their TLS handshakes) are reused between requests.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
+
+
+def make_spotify_session():
+    """Creates the aiohttp session for a run. It must be called from inside the running event loop.
+    It keeps a warm pool of connections to api.spotify.com and caches its dns lookups for the whole run."""
+    connector = aiohttp.TCPConnector(
+        limit=64,
+        limit_per_host=20,
+        use_dns_cache=True,
+        ttl_dns_cache=300,
+        resolver=aiohttp.AsyncResolver(),
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def spotify_get(session, url, token_cache, params=None, description="data", max_retries=3, max_throttled_retries=10, sleep_time=1):
+    """Gets a spotify api url with a requests session and returns the parsed json"""
+    # The one-time token refresh and the Retry-After waits don't count against max_retries, which is only for errors.
+    attempt = 0
+    throttled_retries = 0
+    token_refreshed = False
+    while attempt < max_retries:
+        try:
+            token = token_cache.get()
+            with spotify_limiter:
+                response = session.get(
+                    url,
+                    headers={"Authorization": f"Bearer {token}"},
+                    params=params,
+                    timeout=10,
+                )
+            # The token expired mid run, get a new one and retry right away instead of backing off.
+            if response.status_code == 401 and not token_refreshed:
+                token_cache.refresh(token)
+                token_refreshed = True
+                logger.warning("Spotify access token expired, refreshed it and retrying.")
+                continue
+            if response.status_code == 429 and throttled_retries < max_throttled_retries:
+                throttled_retries += 1
+                retry_after = get_retry_after(response.headers, sleep_time)
+                spotify_limiter.on_throttle(retry_after)
+                logger.warning(
+                    f"Rate limited by spotify while getting {description}. Retrying in {retry_after} seconds (throttled {throttled_retries}/{max_throttled_retries})."
+                )
+                continue
+            response.raise_for_status()
+            spotify_limiter.on_success()
+            return orjson.loads(response.content)
+        except Exception as e:
+            backoff_time = get_backoff_time(sleep_time, attempt)
+            logger.warning(
+                f"Error getting {description} from spotify: {e}. Retrying in {backoff_time} seconds (attempt {attempt+1}/{max_retries})."
+            )
+            time.sleep(backoff_time)
+            attempt += 1
+    logger.error(
+        f"Error getting {description} from spotify. Failed after {max_retries} attempts."
+    )
+    raise RuntimeError(
+        f"Error getting {description} from spotify. Failed after {max_retries} attempts."
+    )
+
+
+async def spotify_get_async(session, url, token_cache, params=None, description="data", max_retries=3, max_throttled_retries=10, sleep_time=1):
+    """Gets a spotify api url with an aiohttp session and returns the parsed json"""
+    # The one-time token refresh and the Retry-After waits don't count against max_retries, which is only for errors.
+    attempt = 0
+    throttled_retries = 0
+    token_refreshed = False
+    while attempt < max_retries:
+        try:
+            token = token_cache.get()
+            async with spotify_limiter, session.get(
+                url,
+                headers={"Authorization": f"Bearer {token}"},
+                params=params,
+                timeout=aiohttp.ClientTimeout(total=10),
+            ) as response:
+                # The token expired mid run, get a new one and retry right away instead of backing off.
+                if response.status == 401 and not token_refreshed:
+                    await asyncio.to_thread(token_cache.refresh, token)
+                    token_refreshed = True
+                    logger.warning("Spotify access token expired, refreshed it and retrying.")
+                    continue
+                if response.status == 429 and throttled_retries < max_throttled_retries:
+                    throttled_retries += 1
+                    retry_after = get_retry_after(response.headers, sleep_time)
+                    spotify_limiter.on_throttle(retry_after)
+                    logger.warning(
+                        f"Rate limited by spotify while getting {description}. Retrying in {retry_after} seconds (throttled {throttled_retries}/{max_throttled_retries})."
+                    )
+                    continue
+                response.raise_for_status()
+                spotify_limiter.on_success()
+                return await response.json(loads=orjson.loads)
+        except Exception as e:
+            backoff_time = get_backoff_time(sleep_time, attempt)
+            logger.warning(
+                f"Error getting {description} from spotify: {e}. Retrying in {backoff_time} seconds (attempt {attempt+1}/{max_retries})."
+            )
+            await asyncio.sleep(backoff_time)
+            attempt += 1
+    logger.error(
+        f"Error getting {description} from spotify. Failed after {max_retries} attempts."
+    )
+    raise RuntimeError(
+        f"Error getting {description} from spotify. Failed after {max_retries} attempts."
+    )
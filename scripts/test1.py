@@ -1,20 +1,27 @@
 import requests
 import re
 import os
+import shutil
+
+# Compiled once and matched on the raw response bytes, so the embed page doesn't need to be decoded.
+PREVIEW_URL_RE = re.compile(rb'"audioPreview"\s*:\s*\{"url":"(https:[^"]+)"\}')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Reuse connections between the embed page and mp3 requests.
+SESSION = requests.Session()
 
 def get_spotify_preview_url(track_id: str) -> str:
     """
     Get the Spotify 30s preview URL using the embed endpoint.
     """
     embed_url = f"https://open.spotify.com/embed/track/{track_id}"
-    resp = requests.get(embed_url, timeout=10)
+    resp = SESSION.get(embed_url, timeout=10)
 
     if resp.status_code != 200:
         raise Exception(f"Failed to fetch embed page: {resp.status_code}")
 
     # Extract preview MP3 URL using regex
-    match = re.search(r'"audioPreview"\s*:\s*\{"url":"(https:[^"]+)"\}', resp.text)
-    return match.group(1) if match else None
+    match = PREVIEW_URL_RE.search(resp.content)
+    return match.group(1).decode("utf-8") if match else None
 
 def download_preview(track_id: str, save_dir="previews"):
     """
@@ -29,14 +36,15 @@ def download_preview(track_id: str, save_dir="previews"):
     filepath = os.path.join(save_dir, f"{track_id}.mp3")
 
     # Download MP3 file
-    resp = requests.get(url, stream=True)
-    if resp.status_code == 200:
-        with open(filepath, "wb") as f:
-            for chunk in resp.iter_content(1024):
-                f.write(chunk)
-        print(f"✅ Downloaded preview: {filepath}")
-    else:
-        print(f"❌ Failed to download preview for {track_id}")
+    # Closing the streamed response returns its connection to the session's pool, also when the download fails.
+    with SESSION.get(url, stream=True, timeout=10) as resp:
+        if resp.status_code == 200:
+            resp.raw.decode_content = True
+            with open(filepath, "wb") as f:
+                shutil.copyfileobj(resp.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+            print(f"✅ Downloaded preview: {filepath}")
+        else:
+            print(f"❌ Failed to download preview for {track_id}")
 
 if __name__ == "__main__":
     # Example: Wonderwall